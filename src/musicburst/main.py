@@ -12,15 +12,16 @@ and the total length of those segments.
 
 import argparse
 import csv
+import json
 import logging
 import os
 import sys
+import tempfile
 
-from collections import defaultdict
-from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
 
-# pympi-ling is required for parsing of EAF files
-import pympi
+# lxml is required for parsing of EAF files
+from lxml import etree
 
 from musicburst import __version__
 
@@ -28,34 +29,52 @@ __author__ = "Michael Richters"
 __copyright__ = "Michael Richters"
 __license__ = "MIT"
 
+_logger = logging.getLogger(__name__)
+
 # ==============================================================================
 # Constants
 MUSIC_TIER_NAME = 'MusicBurst'
 SOURCE_TIER_NAME = 'Source'
+SINGING_VALUE = '1'
+CACHE_VERSION = 2
 
 # ==============================================================================
 class OutputRecord:
     """Represents a row of the data table to be written to the output file"""
+    __slots__ = ('filename', 'missing_source_tier',
+                 'total_time',
+                 'music_segments', 'music_time',
+                 'singing_segments', 'singing_time')
     data_labels = ['total time',
                    'music segments', 'music time',
                    'singing segments', 'singing time']
+    data_attrs = ['total_time',
+                  'music_segments', 'music_time',
+                  'singing_segments', 'singing_time']
     header = ['filename']
     header.extend(data_labels)
 
     def __init__(self, filename):
-        self.filename = os.path.basename(filename).replace('.eaf', '')
-        self.data = defaultdict(int)
+        basename = os.path.basename(filename)
+        self.filename = basename[:-4] if basename.endswith('.eaf') else basename
+        self.missing_source_tier = False
+        self.total_time = 0
+        self.music_segments = 0
+        self.music_time = 0
+        self.singing_segments = 0
+        self.singing_time = 0
+
+    def values(self):
+        """Return the data values of the output record, in column order"""
+        return (self.total_time,
+                self.music_segments, self.music_time,
+                self.singing_segments, self.singing_time)
 
     def fmt(self):
         """Format the output record, returning a list of values, with zeros replaced by
         empty strings."""
-        values = [self.filename]
-        def _blank_zero(entry):
-            value = self.data[entry]
-            return '' if value == 0 else value
-        data_values = map(_blank_zero, self.data_labels)
-        values.extend(data_values)
-        return values
+        return [self.filename] + [('' if value == 0 else value)
+                                  for value in self.values()]
 
 # ------------------------------------------------------------------------------
 class Error(Exception):
@@ -71,6 +90,108 @@ class InputError(Error):
         super().__init__()
         self.message = message
 
+# ------------------------------------------------------------------------------
+class ResultCache:
+    """On-disk cache of output data for EAF files that have already been
+    processed, so that unchanged files need not be parsed again on later runs.
+
+    Entries are keyed by absolute path, and are only used if the file's
+    modification time and size still match those recorded with them. The
+    whole cache is discarded if it was written by a different version of
+    musicburst, or with a different cache format.
+
+    Attributes:
+        path (string): filename of the JSON file holding the cache
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.modified = False
+        try:
+            with open(path, encoding='utf-8') as cache_file:
+                contents = json.load(cache_file)
+            if (isinstance(contents, dict)
+                    and contents.get('version') == CACHE_VERSION
+                    and contents.get('musicburst') == __version__
+                    and isinstance(contents.get('entries'), dict)):
+                self.entries = contents['entries']
+        except (OSError, ValueError):
+            _logger.debug("Not using cache file %s", path)
+
+    @staticmethod
+    def default_path():
+        """Return the default location of the cache file, in the user's cache
+        directory (``$XDG_CACHE_HOME``, or ``~/.cache``)"""
+        cache_dir = (os.environ.get('XDG_CACHE_HOME')
+                     or os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(cache_dir, 'musicburst', 'results.json')
+
+    @staticmethod
+    def key(eaf_file):
+        """Return the cache key for an EAF file, or ``None`` if it can't be
+        examined"""
+        try:
+            stat = os.stat(eaf_file)
+        except OSError:
+            return None
+        return (os.path.abspath(eaf_file), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, eaf_file, key):
+        """Return the cached :obj:`OutputRecord` for ``key``, or ``None`` if
+        there is no valid entry for it"""
+        if key is None:
+            return None
+        (path, mtime, size) = key
+        entry = self.entries.get(path)
+        # Damaged entries are treated as missing
+        if (not isinstance(entry, list)
+                or len(entry) != 3 + len(OutputRecord.data_attrs)
+                or entry[:2] != [mtime, size]):
+            return None
+        output_record = OutputRecord(eaf_file)
+        output_record.missing_source_tier = entry[2]
+        for (attr, value) in zip(OutputRecord.data_attrs, entry[3:]):
+            setattr(output_record, attr, value)
+        return output_record
+
+    def put(self, key, output_record):
+        """Store the data from ``output_record`` under ``key``"""
+        if key is None:
+            return
+        (path, mtime, size) = key
+        self.entries[path] = ([mtime, size, output_record.missing_source_tier]
+                              + list(output_record.values()))
+        self.modified = True
+
+    def save(self):
+        """Write the cache back to disk, if it has changed, dropping entries
+        for files that no longer exist"""
+        stale = [path for path in self.entries if not os.path.exists(path)]
+        for path in stale:
+            del self.entries[path]
+        if not (self.modified or stale):
+            return
+
+        # Write to a temporary file unique to this run, and move it into place,
+        # so that concurrent runs can't leave a mix of their contents behind
+        cache_dir = os.path.dirname(self.path)
+        temp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_dir,
+                                             suffix='.tmp', delete=False) as cache_file:
+                temp_path = cache_file.name
+                json.dump({'version':    CACHE_VERSION,
+                           'musicburst': __version__,
+                           'entries':    self.entries},
+                          cache_file)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            _logger.warning("Could not write cache file %s: %s", self.path, err)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.modified = False
+
 # ==============================================================================
 def parse_args(args):
     """Parse command line parameters
@@ -107,9 +228,9 @@ def parse_args(args):
     parser.add_argument(
         '-o', '--output',
         metavar = '<csv_file>',
-        type    = argparse.FileType('w'),
         default = 'musicburst-counts.csv',
-        help    = "Write output to <csv_file> (default: '%(default)s')",
+        help    = "Write output to <csv_file>, or '-' for standard output "
+                  "(default: '%(default)s')",
     )
     parser.add_argument(
         '-d', '--delimiter',
@@ -117,6 +238,13 @@ def parse_args(args):
         default = 'comma',
         help    = "Use <delimiter> as CSV output field separator (default: '%(default)s')",
     )
+    parser.add_argument(
+        '--no-cache',
+        dest    = 'use_cache',
+        action  = 'store_false',
+        help    = "Parse every EAF file, instead of reusing results cached from "
+                  "earlier runs for unchanged files",
+    )
     parser.add_argument(
         'eaf_files',
         metavar = '<eaf_file>',
@@ -141,26 +269,163 @@ def setup_logging(loglevel):
     )
 
 # ==============================================================================
-def setup_output(filename, delimiter):
+def setup_output(outfile, delimiter):
     """Setup CSV output and write header row
 
     Args:
-      :obj:`argparse.Namespace`: command line parameters namespace
+      outfile (file): open text file to write CSV data to
+      delimiter (string): CSV field separator
 
     Returns:
       :obj:`csv.writer`: CSV output object
     """
 
     # Create the CSV writer object as specified by args
-    output = csv.writer(filename,
+    output = csv.writer(outfile,
                         delimiter      = delimiter,
                         quoting        = csv.QUOTE_MINIMAL,
                         lineterminator = '\n')
     # Write the header row
-    logging.debug("Writing output header")
+    _logger.debug("Writing output header")
     output.writerow(OutputRecord.header)
     return output
 
+# ==============================================================================
+def _parse_eaf_fast(path):
+    """Stream an EAF file, reducing it to an output record without building a
+    tree of the whole document
+
+    Args:
+      path (string): filename of an EAF file to analyze
+
+    Returns:
+      :obj:`OutputRecord`: record containing the output data
+    """
+    timeslots = {}
+    aligned = {}
+    refs = {}
+    music_annotations = []
+    source_annotations = []
+    tier_names = []
+    music_segments = 0
+    music_time = 0
+    singing_segments = 0
+    singing_time = 0
+    debug = _logger.isEnabledFor(logging.DEBUG)
+
+    # lxml's parse errors can't be pickled back from a worker process, so
+    # they (and I/O errors) are reported as input errors instead
+    try:
+        with open(path, 'rb') as eaf:
+            # iterparse() reads the file in chunks as it goes, so the file is
+            # never copied into memory as a whole; tell the kernel the access is
+            # sequential so it can read ahead more aggressively.
+            # This is only a hint, and fails on pipes (e.g. process
+            # substitution), which are read sequentially anyway.
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(eaf.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+
+            # A single pass over the document: the time slots all precede the
+            # tiers, and the current tier is known from its start tag. Either tier
+            # may hold aligned or reference annotations, and a reference
+            # annotation (as in the 'Source' tier, usually) inherits its times
+            # from the aligned annotation at the end of its chain of references,
+            # which may be in a later tier. So the time intervals of all aligned
+            # annotations, and all references, are kept, and the annotations of
+            # the two tiers are resolved after the pass.
+            #
+            # iterparse() takes libxml2 parser options directly (not a parser
+            # object): lift the size limits for very large corpora, and skip the
+            # ID table, entity resolution and whitespace-only text nodes, none of
+            # which are needed here.
+            current_tier = None
+            events = etree.iterparse(eaf,
+                                     events            = ('start', 'end'),
+                                     tag               = ('TIME_SLOT', 'TIER',
+                                                          'ANNOTATION'),
+                                     huge_tree         = True,
+                                     collect_ids       = False,
+                                     resolve_entities  = False,
+                                     remove_blank_text = True)
+            for event, elem in events:
+                if event == 'start':
+                    if elem.tag == 'TIER':
+                        current_tier = elem.get('TIER_ID')
+                        tier_names.append(current_tier)
+                    continue
+
+                if elem.tag == 'TIME_SLOT':
+                    value = elem.get('TIME_VALUE')
+                    timeslots[elem.get('TIME_SLOT_ID')] = (
+                        None if value is None else int(value))
+                elif elem.tag == 'ANNOTATION':
+                    annotation = elem[0]
+                    annotation_id = annotation.get('ANNOTATION_ID')
+                    value = annotation.findtext('ANNOTATION_VALUE')
+                    if annotation.tag == 'ALIGNABLE_ANNOTATION':
+                        aligned[annotation_id] = (
+                            timeslots[annotation.get('TIME_SLOT_REF1')],
+                            timeslots[annotation.get('TIME_SLOT_REF2')])
+                    else:
+                        refs[annotation_id] = annotation.get('ANNOTATION_REF')
+                    if current_tier == MUSIC_TIER_NAME:
+                        music_annotations.append((annotation_id, value))
+                    elif current_tier == SOURCE_TIER_NAME:
+                        source_annotations.append((annotation_id, value))
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+    except (etree.XMLSyntaxError, OSError) as err:
+        raise InputError("Unable to parse {}: {}".format(path, err)) from err
+
+    _logger.debug("All tiers: %s", tier_names)
+    tier_set = frozenset(tier_names)
+
+    if MUSIC_TIER_NAME not in tier_set:
+        raise InputError("Missing {} tier in file {}"
+                         .format(MUSIC_TIER_NAME, path))
+
+    missing_source_tier = SOURCE_TIER_NAME not in tier_set
+    if missing_source_tier:
+        _logger.warning("Missing source tier in file %s", path)
+
+    def _intervals(annotations):
+        for (annotation_id, value) in annotations:
+            # Follow the chain of references up to an aligned annotation
+            while annotation_id not in aligned:
+                annotation_id = refs[annotation_id]
+            (start, end) = aligned[annotation_id]
+            yield (start, end, value)
+
+    for (start, end, value) in _intervals(music_annotations):
+        if debug:
+            _logger.debug("%s segment: (%s, %s, %s)",
+                          MUSIC_TIER_NAME, start, end, value)
+        music_segments += 1
+        music_time += (end - start)
+
+    for (start, end, value) in _intervals(source_annotations):
+        if debug:
+            _logger.debug("%s segment: (%s, %s, %s)",
+                          SOURCE_TIER_NAME, start, end, value)
+        if value == SINGING_VALUE:
+            singing_segments += 1
+            singing_time += (end - start)
+
+    times = [time for time in timeslots.values() if time is not None]
+
+    output_record = OutputRecord(path)
+    output_record.missing_source_tier = missing_source_tier
+    output_record.total_time = (max(times) - min(times)) if times else 0
+    output_record.music_segments = music_segments
+    output_record.music_time = music_time
+    output_record.singing_segments = singing_segments
+    output_record.singing_time = singing_time
+    return output_record
+
 # ==============================================================================
 def collect_music_data(eaf_file):
     """Collect data from an EAF file
@@ -171,45 +436,78 @@ def collect_music_data(eaf_file):
     Returns:
       :obj:`OutputRecord`: record containing the output data
     """
-    logging.info("Processing %s", eaf_file)
+    _logger.info("Processing %s", eaf_file)
+    return _parse_eaf_fast(eaf_file)
 
-    # pympi prints warnings about EAF versions to STDOUT instead of STDERR. This
-    # gets in the way of CSV output to STDOUT.
-    with redirect_stdout(sys.stderr):
-        eaf = pympi.Elan.Eaf(eaf_file)
+def _collect_music_data_or_error(eaf_file):
+    """Call :func:`collect_music_data` in a worker process, returning input
+    errors instead of raising them, so that they can be reported by the parent
 
-    tier_names = eaf.get_tier_names()
-    logging.debug("All tiers: %s", format(list(tier_names)))
+    Args:
+      eaf_file (string): filename of an EAF file to analyze
 
-    output_record = OutputRecord(eaf_file)
+    Returns:
+      tuple: ``(output_record, None)`` on success, or ``(None, message)`` if the
+          file could not be processed
+    """
+    try:
+        return (collect_music_data(eaf_file), None)
+    except InputError as err:
+        return (None, err.message)
 
-    if MUSIC_TIER_NAME not in tier_names:
-        raise InputError("Missing {} tier in file {}"
-                         .format(MUSIC_TIER_NAME, eaf_file))
+def iter_music_data(eaf_files, loglevel, cache=None):
+    """Collect data from a set of EAF files, in parallel, skipping files with
+    valid entries in ``cache``
 
-    for record in eaf.get_annotation_data_for_tier(MUSIC_TIER_NAME):
-        (start, end, value) = record[:3]
-        logging.debug("%s segment: %s",
-                      MUSIC_TIER_NAME, format((start, end, value)))
-        output_record.data['music segments'] += 1
-        output_record.data['music time'] += (end - start)
+    Args:
+      eaf_files (List[str]): filenames of the EAF files to analyze
+      loglevel (int): minimum loglevel for worker processes
+      cache (:obj:`ResultCache`): cache of previous results, if any
 
-    if SOURCE_TIER_NAME not in tier_names:
-        logging.warning("Missing source tier in file %s", eaf_file)
+    Yields:
+      tuple: ``(output_record, error)`` for each file, in order, as returned by
+          :func:`_collect_music_data_or_error`
+    """
+    keys = [None] * len(eaf_files)
+    cached = [None] * len(eaf_files)
+    if cache is not None:
+        for (i, eaf_file) in enumerate(eaf_files):
+            keys[i] = cache.key(eaf_file)
+            cached[i] = cache.get(eaf_file, keys[i])
+    uncached = [eaf_file for (eaf_file, output_record) in zip(eaf_files, cached)
+                if output_record is None]
+
+    # Each EAF file is processed independently, so they are spread across
+    # worker processes (as many as the executor's default allows for this
+    # platform); results are still returned in input order. A single file is
+    # not worth starting a pool for.
+    executor = None
+    if len(uncached) > 1:
+        executor = ProcessPoolExecutor(initializer = setup_logging,
+                                       initargs    = (loglevel,))
+        # pylint: disable=protected-access
+        chunksize = max(1, len(uncached) // (4 * executor._max_workers))
+        results = executor.map(_collect_music_data_or_error,
+                               uncached, chunksize=chunksize)
     else:
-        for record in eaf.get_annotation_data_for_tier('Source'):
-            (start, end, value) = record[:3]
-            logging.debug("%s segment: %s",
-                          SOURCE_TIER_NAME, format((start, end, value)))
-            if value != '1':
+        results = map(_collect_music_data_or_error, uncached)
+
+    try:
+        for (eaf_file, key, output_record) in zip(eaf_files, keys, cached):
+            if output_record is not None:
+                _logger.info("Using cached data for %s", eaf_file)
+                if output_record.missing_source_tier:
+                    _logger.warning("Missing source tier in file %s", eaf_file)
+                yield (output_record, None)
                 continue
-            output_record.data['singing segments'] += 1
-            output_record.data['singing time'] += (end - start)
 
-    (start, end) = eaf.get_full_time_interval()
-    output_record.data['total time'] = (end - start)
-
-    return output_record
+            (output_record, error) = next(results)
+            if cache is not None and error is None:
+                cache.put(key, output_record)
+            yield (output_record, error)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 # ==============================================================================
 def main(args):
@@ -232,19 +530,39 @@ def main(args):
     elif args.delimiter == 'ascii':
         output_delimiter = '\x1f'
 
-    output = setup_output(args.output, output_delimiter)
-
-    for eaf_file in args.eaf_files:
+    # The output file is only opened (and truncated) once the arguments have
+    # been parsed successfully; failure to open it is still a usage error.
+    if args.output == '-':
+        outfile = sys.stdout
+    else:
         try:
-            output_record = collect_music_data(eaf_file)
-        except InputError as err:
-            logging.warning(err.message)
-            continue
-
-        output.writerow(output_record.fmt())
+            outfile = open(args.output, 'w', buffering=1 << 20, newline='')
+        except OSError as err:
+            _logger.error("argument -o/--output: can't open '%s': %s",
+                          args.output, err)
+            sys.exit(2)
+
+    cache = ResultCache(ResultCache.default_path()) if args.use_cache else None
+
+    try:
+        output = setup_output(outfile, output_delimiter)
+
+        # Rows are written as soon as they are available (the output file's
+        # buffer batches the actual writes), so that nothing is lost if a
+        # later file fails.
+        for (output_record, error) in iter_music_data(args.eaf_files,
+                                                      args.loglevel, cache):
+            if error is not None:
+                _logger.warning(error)
+                continue
 
-    if args.output != sys.stdout:
-        args.output.close()
+            output.writerow(output_record.fmt())
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+        # Keep the results of files processed so far, even if the run failed
+        if cache is not None:
+            cache.save()
 
 
 def run():
@@ -1,10 +1,17 @@
 """
-    Dummy conftest.py for musicburst.
+    conftest.py for musicburst.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     - https://docs.pytest.org/en/stable/fixture.html
     - https://docs.pytest.org/en/stable/writing_plugins.html
 """
 
-# import pytest
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    """Keep the result cache of each test in a temporary directory"""
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cache_dir))
+    return cache_dir
@@ -0,0 +1,115 @@
+"""
+Tests for collect_music_data() function
+"""
+import os
+import threading
+
+import pytest
+from lxml import etree
+
+from musicburst.main import collect_music_data, InputError
+
+__author__ = "Michael Richters"
+__copyright__ = "Michael Richters"
+__license__ = "MIT"
+
+TEST_EAF = 'tests/test.eaf'
+
+def _tier(tree, tier_id):
+    return tree.find('TIER[@TIER_ID="{}"]'.format(tier_id))
+
+def _aligned_source(tree):
+    """Make the 'Source' tier time-aligned instead of referring to 'MusicBurst'"""
+    music_tier = _tier(tree, 'MusicBurst')
+    source_tier = _tier(tree, 'Source')
+    del source_tier.attrib['PARENT_REF']
+    for annotation in source_tier.iter('REF_ANNOTATION'):
+        parent = music_tier.find('.//ALIGNABLE_ANNOTATION[@ANNOTATION_ID="{}"]'
+                                 .format(annotation.get('ANNOTATION_REF')))
+        annotation.tag = 'ALIGNABLE_ANNOTATION'
+        del annotation.attrib['ANNOTATION_REF']
+        annotation.set('TIME_SLOT_REF1', parent.get('TIME_SLOT_REF1'))
+        annotation.set('TIME_SLOT_REF2', parent.get('TIME_SLOT_REF2'))
+
+def _ref_chain(tree):
+    """Make the 'Source' tier refer to 'Vocal', which refers to 'MusicBurst'"""
+    vocal_ids = {annotation.get('ANNOTATION_REF'): annotation.get('ANNOTATION_ID')
+                 for annotation in _tier(tree, 'Vocal').iter('REF_ANNOTATION')}
+    source_tier = _tier(tree, 'Source')
+    source_tier.set('PARENT_REF', 'Vocal')
+    for annotation in source_tier.iter('REF_ANNOTATION'):
+        annotation.set('ANNOTATION_REF', vocal_ids[annotation.get('ANNOTATION_REF')])
+
+def _ref_music(tree):
+    """Make 'MusicBurst' a reference tier, referring to an aligned tier that
+    comes after it in the file"""
+    music_tier = _tier(tree, 'MusicBurst')
+    aligned_tier = etree.SubElement(tree.getroot(), 'TIER',
+                                    LINGUISTIC_TYPE_REF='MusicBurst',
+                                    TIER_ID='Segments')
+    aligned_tier.extend(music_tier)
+    music_tier.set('PARENT_REF', 'Segments')
+    for aligned in aligned_tier.iter('ALIGNABLE_ANNOTATION'):
+        annotation = etree.SubElement(music_tier, 'ANNOTATION')
+        reference = etree.SubElement(annotation, 'REF_ANNOTATION',
+                                     ANNOTATION_ID=aligned.get('ANNOTATION_ID') + 'r',
+                                     ANNOTATION_REF=aligned.get('ANNOTATION_ID'))
+        etree.SubElement(reference, 'ANNOTATION_VALUE')
+
+def _missing_music(tree):
+    """Remove the 'MusicBurst' tier"""
+    _tier(tree, 'MusicBurst').set('TIER_ID', 'Segments')
+
+def _write_variant(tmp_path, name, transform):
+    tree = etree.parse(TEST_EAF)
+    transform(tree)
+    eaf_file = tmp_path / (name + '.eaf')
+    tree.write(str(eaf_file))
+    return str(eaf_file)
+
+def test_collect_music_data():
+    """Source tier referring to MusicBurst tier"""
+    output_record = collect_music_data(TEST_EAF)
+    assert output_record.fmt() == ['test', 7320009, 48, 638273, 18, 128369]
+
+@pytest.mark.parametrize('transform', [_aligned_source, _ref_chain, _ref_music])
+def test_tier_types(tmp_path, transform):
+    """Aligned and reference annotations in either tier are counted"""
+    eaf_file = _write_variant(tmp_path, 'variant', transform)
+    output_record = collect_music_data(eaf_file)
+    assert output_record.fmt() == ['variant', 7320009, 48, 638273, 18, 128369]
+
+def test_missing_music_tier(tmp_path):
+    """Files without a MusicBurst tier are rejected"""
+    eaf_file = _write_variant(tmp_path, 'variant', _missing_music)
+    with pytest.raises(InputError):
+        collect_music_data(eaf_file)
+
+def test_malformed_file(tmp_path):
+    """Unparsable files are reported as input errors"""
+    eaf_file = tmp_path / 'broken.eaf'
+    eaf_file.write_text('<ANNOTATION_DOCUMENT><TIER TIER_ID="MusicBurst">')
+    with pytest.raises(InputError) as excinfo:
+        collect_music_data(str(eaf_file))
+    assert str(eaf_file) in excinfo.value.message
+
+def test_missing_file(tmp_path):
+    """Missing files are reported as input errors"""
+    with pytest.raises(InputError):
+        collect_music_data(str(tmp_path / 'missing.eaf'))
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason="requires named pipes")
+def test_pipe_input(tmp_path):
+    """EAF data can be read from a pipe"""
+    fifo = tmp_path / 'pipe.eaf'
+    os.mkfifo(str(fifo))
+    def _feed():
+        with open(TEST_EAF, 'rb') as source, open(str(fifo), 'wb') as sink:
+            sink.write(source.read())
+    writer = threading.Thread(target=_feed)
+    writer.start()
+    try:
+        output_record = collect_music_data(str(fifo))
+    finally:
+        writer.join()
+    assert output_record.fmt() == ['pipe', 7320009, 48, 638273, 18, 128369]
@@ -1,9 +1,13 @@
 """
 Tests for main() function
 """
+import json
+import os
+from pathlib import Path
+
 import pytest
 
-from musicburst.main import main
+from musicburst.main import main, OutputRecord
 
 __author__ = "Michael Richters"
 __copyright__ = "Michael Richters"
@@ -26,3 +30,126 @@ def test_main(capsys):
         print(line)
     assert csv_output[0] == ','.join(HEADERS)
     assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+def test_output_file(tmp_path):
+    """Output written to a named CSV file"""
+    csv_file = tmp_path / 'counts.csv'
+    main(['-o', str(csv_file), 'tests/test.eaf'])
+    csv_output = csv_file.read_text().split('\n')
+    assert csv_output[0] == ','.join(HEADERS)
+    assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+def test_bad_args_keep_output(tmp_path):
+    """An existing output file is untouched if argument parsing fails"""
+    csv_file = tmp_path / 'counts.csv'
+    csv_file.write_text('previous results\n')
+    with pytest.raises(SystemExit):
+        main(['-o', str(csv_file), '-d', 'bogus', 'tests/test.eaf'])
+    assert csv_file.read_text() == 'previous results\n'
+
+def test_bad_output_path(caplog, tmp_path):
+    """An output file that can't be opened is a usage error"""
+    csv_file = tmp_path / 'missing' / 'counts.csv'
+    with pytest.raises(SystemExit) as excinfo:
+        main(['-o', str(csv_file), 'tests/test.eaf'])
+    assert excinfo.value.code == 2
+    assert "can't open '{}'".format(csv_file) in caplog.text
+
+def test_cache(capsys, cache_home):
+    """Results for unchanged files are reused from the cache"""
+    main(['-o', '-', 'tests/test.eaf'])
+    cache_file = cache_home / 'musicburst' / 'results.json'
+    cache = json.loads(cache_file.read_text())
+    (entry,) = cache['entries'].values()
+    # Tamper with the cached values to tell a cache hit from a new parse
+    entry[4] = 1
+    cache_file.write_text(json.dumps(cache))
+    capsys.readouterr()
+
+    main(['-o', '-', 'tests/test.eaf'])
+    csv_output = capsys.readouterr().out.split('\n')
+    assert csv_output[1] == "test,7320009,1,638273,18,128369"
+
+    main(['-o', '-', '--no-cache', 'tests/test.eaf'])
+    csv_output = capsys.readouterr().out.split('\n')
+    assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+def test_bad_file_skipped(capsys, caplog, tmp_path):
+    """Unparsable files are skipped with a warning"""
+    eaf_file = tmp_path / 'broken.eaf'
+    eaf_file.write_text('<ANNOTATION_DOCUMENT>')
+    main(['-o', '-', str(eaf_file), 'tests/test.eaf'])
+    csv_output = capsys.readouterr().out.split('\n')
+    assert "Unable to parse {}".format(eaf_file) in caplog.text
+    assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+def test_cache_missing_source_warning(caplog, tmp_path):
+    """The missing source tier warning is repeated for cached results"""
+    eaf_file = tmp_path / 'no_source.eaf'
+    eaf_file.write_text(
+        Path('tests/test.eaf').read_text().replace('TIER_ID="Source"',
+                                                   'TIER_ID="Origin"'))
+    warning = "Missing source tier in file {}".format(eaf_file)
+    main(['-o', '-', str(eaf_file)])
+    caplog.clear()
+    main(['-o', '-', str(eaf_file)])
+    assert warning in caplog.text
+
+def test_cache_saved_on_error(monkeypatch, cache_home, tmp_path):
+    """Results are cached even if a later file fails"""
+    def _fail(output_record):
+        raise RuntimeError("write failed")
+    monkeypatch.setattr(OutputRecord, 'fmt', _fail)
+    with pytest.raises(RuntimeError):
+        main(['-o', str(tmp_path / 'counts.csv'), 'tests/test.eaf'])
+    cache = json.loads((cache_home / 'musicburst' / 'results.json').read_text())
+    assert os.path.abspath('tests/test.eaf') in cache['entries']
+
+def test_cache_other_version(capsys, cache_home):
+    """Results cached by another version of musicburst are not used"""
+    main(['-o', '-', 'tests/test.eaf'])
+    cache_file = cache_home / 'musicburst' / 'results.json'
+    cache = json.loads(cache_file.read_text())
+    (entry,) = cache['entries'].values()
+    entry[4] = 1
+    cache['musicburst'] = 'other'
+    cache_file.write_text(json.dumps(cache))
+    capsys.readouterr()
+
+    main(['-o', '-', 'tests/test.eaf'])
+    csv_output = capsys.readouterr().out.split('\n')
+    assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+@pytest.mark.parametrize('entries', [5, [], 'entries', {'entry': 5},
+                                     {'entry': [1, 2]}, {'entry': None}])
+def test_damaged_cache(capsys, cache_home, entries):
+    """A damaged cache file is ignored"""
+    main(['-o', '-', 'tests/test.eaf'])
+    cache_file = cache_home / 'musicburst' / 'results.json'
+    cache = json.loads(cache_file.read_text())
+    if isinstance(entries, dict):
+        # Replace the entry for the test file itself
+        cache['entries'] = {path: entries['entry'] for path in cache['entries']}
+    else:
+        cache['entries'] = entries
+    cache_file.write_text(json.dumps(cache))
+    capsys.readouterr()
+
+    main(['-o', '-', 'tests/test.eaf'])
+    csv_output = capsys.readouterr().out.split('\n')
+    assert csv_output[1] == "test,7320009,48,638273,18,128369"
+
+def test_cache_drops_missing_files(cache_home, tmp_path):
+    """Cache entries for files that no longer exist are removed"""
+    eaf_file = tmp_path / 'copy.eaf'
+    eaf_file.write_bytes(Path('tests/test.eaf').read_bytes())
+    main(['-o', str(tmp_path / 'counts.csv'), str(eaf_file), 'tests/test.eaf'])
+    cache_dir = cache_home / 'musicburst'
+    cache = json.loads((cache_dir / 'results.json').read_text())
+    assert str(eaf_file) in cache['entries']
+
+    eaf_file.unlink()
+    main(['-o', str(tmp_path / 'counts.csv'), 'tests/test.eaf'])
+    cache = json.loads((cache_dir / 'results.json').read_text())
+    assert list(cache['entries']) == [os.path.abspath('tests/test.eaf')]
+    assert [path.name for path in cache_dir.iterdir()] == ['results.json']
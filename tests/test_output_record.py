@@ -0,0 +1,25 @@
+"""
+Tests for the OutputRecord class
+"""
+import os
+
+from musicburst.main import OutputRecord
+
+__author__ = "Michael Richters"
+__copyright__ = "Michael Richters"
+__license__ = "MIT"
+
+def test_filename():
+    """Directory and '.eaf' suffix are stripped from the file name"""
+    assert OutputRecord(os.path.join('data', 'test.eaf')).filename == 'test'
+    assert OutputRecord('test.eaf.eaf').filename == 'test.eaf'
+    assert OutputRecord('a.eafb.eaf').filename == 'a.eafb'
+    assert OutputRecord('test.xml').filename == 'test.xml'
+
+def test_fmt():
+    """Zero values are written as empty fields"""
+    output_record = OutputRecord('test.eaf')
+    output_record.total_time = 1000
+    output_record.music_segments = 2
+    output_record.music_time = 500
+    assert output_record.fmt() == ['test', 1000, 2, 500, '', '']